@@ -381,9 +381,9 @@ def load_mesh(filename, mesh_root_dir, scale=None):
         mesh_fname = data["object"].decode('utf-8')
         mesh_scale = data["object_scale"] if scale is None else scale
     elif filename.endswith(".h5"):
-        data = h5py.File(filename, "r")
-        mesh_fname = data["object/file"][()].decode('utf-8')
-        mesh_scale = data["object/scale"][()] if scale is None else scale
+        with h5py.File(filename, "r") as data:
+            mesh_fname = data["object/file"][()].decode('utf-8')
+            mesh_scale = data["object/scale"][()] if scale is None else scale
     else:
         raise RuntimeError("Unknown file ending:", filename)
 
@@ -416,11 +416,12 @@ def load_grasps(filename, load_subsampled=False):
         T = np.array(data["transforms"])
         success = np.array(data["quality_flex_object_in_gripper"])
     elif filename.endswith(".h5"):
-        data = h5py.File(filename, "r")
-        T = np.array(data["grasps/transforms"])
-        success = np.array(data["grasps/qualities/flex/object_in_gripper"])
+        with h5py.File(filename, "r") as data:
+            T = np.array(data["grasps/transforms"])
+            success = np.array(data["grasps/qualities/flex/object_in_gripper"])
+            if load_subsampled:
+                idxs = np.array(data["grasps/sampled_idxs"])
         if load_subsampled:
-            idxs = np.array(data["grasps/sampled_idxs"])
             T = T[idxs]
             success = success[idxs]
     else:
@@ -59,12 +59,12 @@ def main(argv=sys.argv[1:]):
         T, success = load_grasps(f, load_subsampled=args.subsampled)
 
         # create visual markers for grasps
-        succ_idxs = np.where(success == 1)[0]
+        succ_idxs = np.flatnonzero(success)
         successful_grasps = [
             create_gripper_marker(color=[0, 255, 0]).apply_transform(t)
             for t in T[np.random.choice(succ_idxs, min(args.num_grasps, len(succ_idxs)), replace=False)]
         ] if len(succ_idxs) > 0 else []
-        fail_idxs = np.where(success == 0)[0]
+        fail_idxs = np.flatnonzero(success == 0)
         failed_grasps = [
             create_gripper_marker(color=[255, 0, 0]).apply_transform(t)
             for t in T[np.random.choice(fail_idxs, min(args.num_grasps, len(fail_idxs)), replace=False)]
@@ -1,24 +1,32 @@
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from pydantic_core import to_json
 import os
 import asyncio
-from tempfile import TemporaryDirectory
 import io
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.responses import FileResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.staticfiles import NotModifiedResponse
+import mimetypes
 from fastapi import HTTPException
 
-import h5py
 import trimesh
 import numpy as np
 import pickle
 import boto3
-import re
+from botocore.config import Config
 
-from acronym_tools import create_gripper_marker
 from annotation import Annotation
+from glb_utils import download_object_data, export_grasp_glb
 
-s3 = boto3.client("s3")
+N_S3_THREADS = 16
+s3 = boto3.client("s3", config=Config(max_pool_connections=N_S3_THREADS))
 
 BUCKET_NAME = "prior-datasets"
 DATA_PREFIX = "semantic-grasping/acronym/"
@@ -30,9 +38,15 @@ else:
     with open("categories.txt", "r") as f:
         CATEGORIES = set(f.read().splitlines())
 
-# maps (category, object_id, grasp_id) -> whether the grasp is annotated
-annotated_grasps: dict[str, dict[str, dict[int, bool]]] = {}
-annotation_lock = asyncio.Lock()
+# maps (category, object_id) -> (sorted grasp ids, whether each grasp is annotated)
+annotated_grasps: dict[str, dict[str, tuple[np.ndarray, np.ndarray]]] = {}
+
+# returns the index of grasp_id in the sorted grasp_ids array, or -1 if it isn't present
+def find_grasp(grasp_ids: np.ndarray, grasp_id: int) -> int:
+    idx = int(np.searchsorted(grasp_ids, grasp_id))
+    if idx < len(grasp_ids) and grasp_ids[idx] == grasp_id:
+        return idx
+    return -1
 
 # load annotation skeleton
 skeleton_bytes = io.BytesIO()
@@ -43,99 +57,118 @@ for category, objs in skeleton.items():
     annotated_grasps[category] = {}
     for obj_id, grasps in objs.items():
         if len(grasps) > 0:
-            annotated_grasps[category][obj_id] = grasps
+            grasp_ids = np.array(sorted(grasps), dtype=np.int32)
+            annotated = np.array([grasps[grasp_id] for grasp_id in grasp_ids], dtype=bool)
+            annotated_grasps[category][obj_id] = (grasp_ids, annotated)
 
 assert all(c in annotated_grasps for c in CATEGORIES), "Some categories are missing from the annotation skeleton!"
 
+def list_annotation_keys(category: str) -> list[str]:
+    paginator = s3.get_paginator("list_objects_v2")
+    keys: list[str] = []
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=f"{ANNOTATION_PREFIX}{category}__"):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
 print("Loading existing annotations...")
-continuation_token = None
-while True:
-    list_kwargs = {"Bucket": BUCKET_NAME, "Prefix": ANNOTATION_PREFIX}
-    if continuation_token:
-        list_kwargs["ContinuationToken"] = continuation_token
-    response = s3.list_objects_v2(**list_kwargs)
-
-    if "Contents" in response:
-        for obj in response["Contents"]:
-            key = obj["Key"]
+# listing is latency-bound, so list each category's keys concurrently
+with ThreadPoolExecutor(max_workers=N_S3_THREADS) as executor:
+    for keys in executor.map(list_annotation_keys, annotated_grasps.keys()):
+        for key in keys:
             if key.endswith(".json"):
                 filename = os.path.basename(key)[:-len(".json")]
                 object_category, object_id, grasp_id, _ = filename.split("__")
                 grasp_id = int(grasp_id)
-                if object_category in annotated_grasps and \
-                    object_id in annotated_grasps[object_category] and \
-                    grasp_id in annotated_grasps[object_category][object_id]:
-                    annotated_grasps[object_category][object_id][grasp_id] = True
-
-    if response.get("IsTruncated"):
-        continuation_token = response["NextContinuationToken"]
-    else:
-        break
+                grasps = annotated_grasps.get(object_category, {}).get(object_id)
+                if grasps is not None and (idx := find_grasp(grasps[0], grasp_id)) >= 0:
+                    grasps[1][idx] = True
 print("Done!")
 
+# per-category annotation counts, kept up to date as annotations are submitted
+category_ann_count: dict[str, int] = {}
+category_unann_count: dict[str, int] = {}
+# per-object unannotated counts, one array per category so sampling weights don't need to be rebuilt
+category_obj_ids: dict[str, list[str]] = {}
+category_obj_idxs: dict[str, dict[str, int]] = {}
+obj_unann_counts: dict[str, np.ndarray] = {}
+for category, objs in annotated_grasps.items():
+    category_obj_ids[category] = list(objs.keys())
+    category_obj_idxs[category] = {obj_id: i for i, obj_id in enumerate(category_obj_ids[category])}
+    obj_unann_counts[category] = np.array([np.count_nonzero(~annotated) for _, annotated in objs.values()], dtype=np.int32)
+    category_ann_count[category] = sum(int(np.count_nonzero(annotated)) for _, annotated in objs.values())
+    category_unann_count[category] = int(obj_unann_counts[category].sum())
+# requests for different categories touch disjoint state, so they don't need to contend on one lock
+category_locks: dict[str, asyncio.Lock] = {category: asyncio.Lock() for category in annotated_grasps}
+CATEGORY_LIST = sorted(CATEGORIES)
+CATEGORY_IDXS = {category: i for i, category in enumerate(CATEGORY_LIST)}
+# unannotated counts of CATEGORY_LIST, used directly as the category sampling weights
+category_weights = np.array([category_unann_count[c] for c in CATEGORY_LIST], dtype=np.int64)
+total_ann_count = sum(category_ann_count.values())
+
 
 def num_annotations_category(category: str):
-    n_annotations = 0
-    for grasps in annotated_grasps[category].values():
-        n_annotations += sum(grasps.values())
-    return n_annotations
+    return category_ann_count[category]
 
 def num_unannotated_category(category: str):
-    n_unannotated = 0
-    for grasps in annotated_grasps[category].values():
-        n_unannotated += sum(1 for annotated in grasps.values() if not annotated)
-    return n_unannotated
+    return category_unann_count[category]
 
 def num_annotations(category: str, obj_id: str):
-    return sum(annotated_grasps[category][obj_id].values())
+    return int(np.count_nonzero(annotated_grasps[category][obj_id][1]))
 
 def num_unannotated(category: str, obj_id: str):
-    return sum(1 for annotated in annotated_grasps[category][obj_id].values() if not annotated)
+    return int(obj_unann_counts[category][category_obj_idxs[category][obj_id]])
 
-def sample_choice(arr, key):
-    if not isinstance(arr, list):
-        arr = list(arr)
-    weights = np.array([key(elem) for elem in arr])
+def sample_choice(arr: list, weights: np.ndarray):
     assert np.all(weights >= 0)
     if np.all(weights == 0):
         return None
     idx = np.random.choice(len(arr), p=weights/weights.sum())
     return arr[idx]
 
+@lru_cache(maxsize=32)
+def _load_object_data(category: str, obj_id: str) -> tuple[trimesh.Scene, np.ndarray]:
+    return download_object_data(s3, BUCKET_NAME, DATA_PREFIX, category, obj_id)
+
 def load_object_data(category: str, obj_id: str) -> tuple[trimesh.Scene, np.ndarray]:
-    datafile_key = f"{DATA_PREFIX}grasps/{category}_{obj_id}.h5"
-    with TemporaryDirectory() as tmpdir:
-        datafile_path = os.path.join(tmpdir, "data.h5")
-        s3.download_file(BUCKET_NAME, datafile_key, datafile_path)
-        with h5py.File(datafile_path, "r") as f:
-            mesh_fname: str = f["object/file"][()].decode("utf-8")
-            mtl_fname = mesh_fname[:-len(".obj")] + ".mtl"
-            mesh_path = os.path.join(tmpdir, os.path.basename(mesh_fname))
-            mtl_path = os.path.join(tmpdir, os.path.basename(mtl_fname))
-            mesh_pfx = DATA_PREFIX + os.path.dirname(mesh_fname) + "/"
-            s3.download_file(BUCKET_NAME, f"{DATA_PREFIX}{mesh_fname}", mesh_path)
-            s3.download_file(BUCKET_NAME, f"{DATA_PREFIX}{mtl_fname}", mtl_path)
-            with open(mtl_path, "r") as mtl_f:
-                for line in mtl_f.read().splitlines():
-                    if m := re.fullmatch(r".+ (.+\.jpg)", line):
-                        texture_fname = m.group(1)
-                        assert texture_fname == os.path.basename(texture_fname), texture_fname
-                        texture_path = os.path.join(tmpdir, texture_fname)
-                        s3.download_file(BUCKET_NAME, f"{mesh_pfx}{texture_fname}", texture_path)
-
-            T = np.array(f["grasps/transforms"])
-            mesh_scale = f["object/scale"][()]
-        obj_mesh = trimesh.load(mesh_path)
-        obj_mesh = obj_mesh.apply_scale(mesh_scale)
-        if isinstance(obj_mesh, trimesh.Scene):
-            scene = obj_mesh
-        elif isinstance(obj_mesh, trimesh.Trimesh):
-            scene = trimesh.Scene([obj_mesh])
+    # the cached scene is shared between requests, so hand out a copy that callers can modify
+    scene, T = _load_object_data(category, obj_id)
+    return scene.copy(), T
+
+def build_mesh_glb(category: str, obj_id: str, grasp_id: int) -> bytes:
+    scene, T = load_object_data(category, obj_id)
+    return export_grasp_glb(scene, T[grasp_id])
+
+# GLBs pregenerated by precompute_glbs.py, laid out as {category}/{object_id}/{grasp_id}.glb
+GLB_CACHE_DIR = os.environ.get("GLB_CACHE_DIR", "glb_cache")
+# maps (category, object_id, grasp_id) -> (GLB bytes, ETag), in LRU order
+GLB_CACHE_SIZE = 128
+glb_cache: OrderedDict[tuple[str, str, int], tuple[bytes, str]] = OrderedDict()
+
+class GLBGZipMiddleware(GZipMiddleware):
+    # GLB payloads are dominated by float vertex buffers, which compress well. Other routes are left alone,
+    # static assets are precompressed and carry strong ETags that must stay tied to one encoding
+    PATH_PREFIX = "/api/get-mesh-data/"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.PATH_PREFIX):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_vary(message):
+            # gzip only adds Vary to the responses it compresses, but the identity ones depend on Accept-Encoding too
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+            await send(message)
+
+        if "gzip" in accepted_encodings(Headers(scope=scope).get("accept-encoding", "")):
+            await super().__call__(scope, receive, send_with_vary)
         else:
-            raise ValueError("Unsupported geometry type")
-    return scene, T
+            await self.app(scope, receive, send_with_vary)
 
 app = FastAPI()
+app.add_middleware(GLBGZipMiddleware, minimum_size=1024)
 
 class ObjectGraspInfo(BaseModel):
     object_category: str
@@ -145,16 +178,17 @@ class ObjectGraspInfo(BaseModel):
 
 @app.post("/api/get-object-info", response_model=ObjectGraspInfo)
 async def get_object_grasp(response: Response):
-    async with annotation_lock:
-        category = sample_choice(CATEGORIES, num_unannotated_category)
-        if category is None:
-            print("All grasps annotated!")
-            response.status_code = 204
-            return ObjectGraspInfo(object_category="", object_id="", grasp_id=-1)
-        obj_id = sample_choice(annotated_grasps[category], key=lambda oid: num_unannotated(category, oid))
-        unannotated_grasps = [grasp_id for grasp_id, annotated in annotated_grasps[category][obj_id].items() if not annotated]
-
-    grasp_id = np.random.choice(unannotated_grasps)
+    category = sample_choice(CATEGORY_LIST, category_weights)
+    if category is None:
+        print("All grasps annotated!")
+        response.status_code = 204
+        return ObjectGraspInfo(object_category="", object_id="", grasp_id=-1)
+    async with category_locks[category]:
+        obj_id = sample_choice(category_obj_ids[category], obj_unann_counts[category])
+        grasp_ids, annotated = annotated_grasps[category][obj_id]
+        unannotated_grasps = grasp_ids[~annotated]
+
+    grasp_id = int(np.random.choice(unannotated_grasps))
     print(f"Chose {category}_{obj_id} with {num_annotations(category, obj_id)} annotations")
 
     return ObjectGraspInfo(
@@ -163,35 +197,121 @@ async def get_object_grasp(response: Response):
         grasp_id=grasp_id
     )
 
-@app.get("/api/get-mesh-data/{category}/{obj_id}/{grasp_id}", responses={200: {"content": {"model/gltf-binary": {}}}}, response_class=Response)
-async def get_mesh_data(category: str, obj_id: str, grasp_id: int):
-    scene, T = load_object_data(category, obj_id)
-    gripper_marker: trimesh.Trimesh = create_gripper_marker(color=[0, 255, 0]).apply_transform(T[grasp_id])
-    gripper_marker.apply_translation(-scene.centroid)
-    scene.apply_translation(-scene.centroid)
-    scene.add_geometry(gripper_marker)
+# GLBGZipMiddleware may compress GLB responses, so the ETags are weak since the bytes depend on the encoding
+GLB_HEADERS = {"Cache-Control": "public, max-age=86400"}
+
+def etag_matches(request: Request, etag: str):
+    # If-None-Match uses weak comparison, i.e. ignoring the W/ prefix on either side
+    etag = etag.removeprefix("W/")
+    return etag in (t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(","))
 
-    glb_bytes = io.BytesIO()
-    scene.export(glb_bytes, file_type="glb")
-    return Response(content=glb_bytes.getvalue(), media_type="model/gltf-binary")
+@app.get("/api/get-mesh-data/{category}/{obj_id}/{grasp_id}", responses={200: {"content": {"model/gltf-binary": {}}}}, response_class=Response)
+async def get_mesh_data(category: str, obj_id: str, grasp_id: int, request: Request):
+    # only serve known grasps, the path params end up in a filesystem path and an S3 key
+    if obj_id not in annotated_grasps.get(category, {}) or find_grasp(annotated_grasps[category][obj_id][0], grasp_id) < 0:
+        raise HTTPException(status_code=404, detail=f"Grasp {grasp_id} not found for {category}_{obj_id}")
+
+    glb_path = os.path.join(GLB_CACHE_DIR, category, obj_id, f"{grasp_id}.glb")
+    if os.path.isfile(glb_path):
+        # FileResponse sets an ETag but doesn't check If-None-Match itself
+        response = FileResponse(glb_path, media_type="model/gltf-binary", headers=GLB_HEADERS, stat_result=os.stat(glb_path))
+        etag = "W/" + response.headers["etag"]
+        response.headers["etag"] = etag
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, **GLB_HEADERS})
+        return response
+
+    key = (category, obj_id, grasp_id)
+    if key in glb_cache:
+        glb_cache.move_to_end(key)
+        glb, etag = glb_cache[key]
+    else:
+        # downloading from S3 and building the GLB both block, so keep them off the event loop
+        glb = await asyncio.to_thread(build_mesh_glb, category, obj_id, grasp_id)
+        etag = f'W/"{hashlib.blake2b(glb, digest_size=16).hexdigest()}"'
+        glb_cache[key] = (glb, etag)
+        if len(glb_cache) > GLB_CACHE_SIZE:
+            glb_cache.popitem(last=False)
+
+    headers = {"ETag": etag, **GLB_HEADERS}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=glb, media_type="model/gltf-binary", headers=headers)
 
 @app.post("/api/submit-annotation")
 async def submit_annotation(annotation: Annotation):
-    async with annotation_lock:
-        total_annotations = sum(map(num_annotations_category, annotated_grasps.keys()))
+    global total_ann_count
     category = annotation.obj.object_category
     obj_id = annotation.obj.object_id
     grasp_id = annotation.grasp_id
     user_id = annotation.user_id
-    print(f"User {user_id} annotated: {category}_{obj_id}, grasp {grasp_id}. Total annotations: {total_annotations+1}")
-
-    annotated_grasps[category][obj_id][grasp_id] = True
-    annotation_key = f"{ANNOTATION_PREFIX}{category}__{obj_id}__{grasp_id}__{user_id}.json"
-    annot_bytes = io.BytesIO(annotation.model_dump_json().encode("utf-8"))
-    s3.upload_fileobj(annot_bytes, BUCKET_NAME, annotation_key)
+    print(f"User {user_id} annotated: {category}_{obj_id}, grasp {grasp_id}. Total annotations: {total_ann_count+1}")
 
+    grasp_ids, annotated = annotated_grasps[category][obj_id]
+    if (idx := find_grasp(grasp_ids, grasp_id)) < 0:
+        raise HTTPException(status_code=404, detail=f"Grasp {grasp_id} not found for {category}_{obj_id}")
 
-app.mount("/static", StaticFiles(directory="data_annotation/build/static"), name="static")
+    annotation_key = f"{ANNOTATION_PREFIX}{category}__{obj_id}__{grasp_id}__{user_id}.json"
+    annot_bytes = io.BytesIO(to_json(annotation))
+    # only mark the grasp as annotated once the upload succeeded, otherwise a failed upload would lose it
+    await asyncio.to_thread(s3.upload_fileobj, annot_bytes, BUCKET_NAME, annotation_key)
+
+    async with category_locks[category]:
+        if not annotated[idx]:
+            annotated[idx] = True
+            category_ann_count[category] += 1
+            category_unann_count[category] -= 1
+            total_ann_count += 1
+            if category in CATEGORY_IDXS:
+                category_weights[CATEGORY_IDXS[category]] -= 1
+            obj_unann_counts[category][category_obj_idxs[category][obj_id]] -= 1
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    # content codings from an Accept-Encoding header, dropping ones explicitly refused with q=0
+    encodings = set()
+    for token in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in token.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            encodings.add(coding.lower())
+    return encodings
+
+class PrecompressedStaticFiles(StaticFiles):
+    # (content encoding, file suffix) pairs, in order of preference
+    ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        # serve a variant compressed at build time if the client accepts it, instead of the raw file
+        request_headers = Headers(scope=scope)
+        encodings = accepted_encodings(request_headers.get("accept-encoding", ""))
+        for encoding, suffix in self.ENCODINGS:
+            compressed_path = f"{full_path}{suffix}"
+            if encoding in encodings and os.path.isfile(compressed_path):
+                response = FileResponse(
+                    compressed_path,
+                    status_code=status_code,
+                    media_type=mimetypes.guess_type(str(full_path))[0] or "text/plain",
+                    headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+                    # stat up front so the ETag/Last-Modified exist for the conditional check below
+                    stat_result=os.stat(compressed_path)
+                )
+                if self.is_not_modified(response.headers, request_headers):
+                    return NotModifiedResponse(response.headers)
+                return response
+        # the identity response also depends on Accept-Encoding, so caches mustn't reuse it for every client
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+app.mount("/static", PrecompressedStaticFiles(directory="data_annotation/build/static"), name="static")
 
 @app.get("/{full_path:path}")
 async def serve_spa(full_path: str):
@@ -202,3 +322,8 @@ async def serve_spa(full_path: str):
         "data_annotation/build/index.html",
         headers={"Cache-Control": "no-cache"}
     )
+
+if __name__ == "__main__":
+    import uvicorn
+    # annotation bookkeeping is held in this process's memory, so this must stay a single worker
+    uvicorn.run(app, host="0.0.0.0", port=8080, loop="uvloop", http="httptools")
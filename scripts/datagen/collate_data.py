@@ -17,18 +17,25 @@ def main():
 
     with open(args.dataset_path, "w", newline='') as f:
         writer = csv.writer(f)
-        writer.writerow(["annotation_id", "text", "observation_path"])  # Write header
+        writer.writerow(["annotation_id", "text", "observation_path", "observation_idx"])  # Write header
         
         for annotation_path in tqdm(glob.glob(os.path.join(args.observation_dir, "**/annot.yaml"), recursive=True)):
             with open(annotation_path, "r") as f:
-                annotation = yaml.safe_load(f)
+                annotations = yaml.safe_load(f)
 
-            annot_id = annotation["annotation_id"]
-            annot_desc = annotation["annotation"]
-            data_path = os.path.relpath(annotation_path.replace("annot.yaml", "obs.pkl"), args.observation_dir)
+            if isinstance(annotations, dict):
+                # legacy layout, one obs_*/ dir per annotation with a single observation in obs.pkl
+                data_path = os.path.relpath(annotation_path.replace("annot.yaml", "obs.pkl"), args.observation_dir)
+                assert os.path.isfile(os.path.join(args.observation_dir, data_path)), f"File {data_path} does not exist"
+                writer.writerow([annotations["annotation_id"], annotations["annotation"], data_path, ""])
+                continue
+
+            # each view stores its observations in one npz, indexed in the same order as its annotations
+            data_path = os.path.relpath(annotation_path.replace("annot.yaml", "obs.npz"), args.observation_dir)
             assert os.path.isfile(os.path.join(args.observation_dir, data_path)), f"File {data_path} does not exist"
 
-            writer.writerow([annot_id, annot_desc, data_path])
+            for obs_idx, annotation in enumerate(annotations):
+                writer.writerow([annotation["annotation_id"], annotation["annotation"], data_path, obs_idx])
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,9 @@
 import argparse
-from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 import json
 import os
 import pickle
-import time
 import uuid
-import base64
 
 # pyrender spawns a lot of OMP threads, limiting to 1 significantly reduces overhead
 if os.environ.get("OMP_NUM_THREADS") is None:
@@ -16,8 +14,8 @@ from tqdm import tqdm
 import numpy as np
 import trimesh
 from trimesh import transformations as tra
+import fcl
 from pydantic import BaseModel
-from itertools import compress
 from PIL import Image, ImageColor
 import yaml
 
@@ -27,6 +25,7 @@ from datagen_utils import (
     look_at_rot,
     random_delta_rot,
     construct_cam_K,
+    inv_transform,
     rejection_sample,
     RejectionSampleError,
     not_none,
@@ -74,6 +73,9 @@ SUPPORT_CATEGORIES = [
 
 ALL_OBJECT_CATEGORIES = open("all_categories.txt").read().splitlines()
 
+# background objects with an xy footprint over this fraction of the support's are skipped without trying to place them
+MAX_BACKGROUND_FOOTPRINT_FRAC = 0.5
+
 GRASP_LOCAL_POINTS = np.array([
     [0.041, 0, 0.066],
     [0.041, 0, 0.112],
@@ -82,6 +84,9 @@ GRASP_LOCAL_POINTS = np.array([
     [-0.041, 0, 0.066]
 ])
 
+GRIPPER_MARKER = create_gripper_marker()
+GRIPPER_BVH = trimesh.collision.mesh_to_BVH(GRIPPER_MARKER)
+
 with open("data/wall_colors.json", "r") as f:
     WALL_COLORS = json.load(f)
 
@@ -91,6 +96,9 @@ def homogenize(arr: np.ndarray):
     else:
         return np.concatenate([arr, np.ones((len(arr), 1))], axis=-1)
 
+GRASP_LOCAL_POINTS_H = homogenize(GRASP_LOCAL_POINTS)
+GRIPPER_CORNERS_H = homogenize(trimesh.bounds.corners(GRIPPER_MARKER.bounds))
+
 def create_plane(width: float, depth: float, center: np.ndarray, normal: np.ndarray):
     corners = [
         (-width / 2.0, -depth / 2.0, 0),
@@ -163,99 +171,131 @@ def generate_lighting(scene: ss.Scene, datagen_cfg: DatagenConfig) -> list[dict]
     ]
     return lights
 
-def on_screen_annotations(datagen_cfg: DatagenConfig, cam_K: np.ndarray, cam_pose: np.ndarray, grasps: np.ndarray):
-    # grasps is (N, 4, 4) poses in scene frame
+def on_screen_annotations(datagen_cfg: DatagenConfig, cam_K: np.ndarray, cam_pose: np.ndarray, grasp_points: np.ndarray):
+    # grasp_points is (N, 5, 3) grasp keypoints in scene frame
     trf = np.eye(4)
     trf[[1,2], [1,2]] = -1  # flip y and z axes, since for trimesh camera -z is forward
-    grasps_cam_frame = trf @ np.linalg.inv(cam_pose)[None] @ grasps
-    grasp_points_cam_frame = homogenize(GRASP_LOCAL_POINTS)[None] @ grasps_cam_frame[:, :-1].transpose(0, 2, 1)
-    grasp_points_img = grasp_points_cam_frame @ cam_K.T
+    # the last row of cam_K is [0, 0, 1], so the projected depth is the camera frame z
+    world_to_img = cam_K @ (trf @ inv_transform(cam_pose))[:3]
+    grasp_points_img = grasp_points @ world_to_img[:, :3].T + world_to_img[:, 3]
+    in_front_mask = np.all(grasp_points_img[..., 2] > 0, axis=-1)
     grasp_points_img = grasp_points_img[..., :2] / grasp_points_img[..., 2:]
 
-    close_mask = np.linalg.norm(grasps_cam_frame[:, :3, 3], axis=-1) <= datagen_cfg.max_grasp_dist
-
-    in_front_mask = np.all(grasp_points_cam_frame[..., 2] > 0, axis=-1)
-
     img_h, img_w = datagen_cfg.img_size
     in_bounds_mask = np.all((grasp_points_img[..., 0] >= 0) & \
         (grasp_points_img[..., 0] < img_w) & \
         (grasp_points_img[..., 1] >= 0) & \
         (grasp_points_img[..., 1] < img_h), axis=-1)
 
-    return close_mask & in_front_mask & in_bounds_mask
+    return in_front_mask & in_bounds_mask
 
-def visible_annotations(scene: ss.Scene, cam_pose: np.ndarray, grasps: np.ndarray):
+def close_annotations(datagen_cfg: DatagenConfig, cam_pose: np.ndarray, grasps: np.ndarray):
     # grasps is (N, 4, 4) poses in scene frame
-    grasp_points = homogenize(GRASP_LOCAL_POINTS)[None] @ grasps[:, :-1].transpose(0, 2, 1)
+    return np.linalg.norm(grasps[:, :3, 3] - cam_pose[:3, 3], axis=-1) <= datagen_cfg.max_grasp_dist
+
+def visible_annotations(intersector: trimesh.ray.ray_triangle.RayMeshIntersector, cam_pose: np.ndarray, grasp_points: np.ndarray):
+    # grasp_points is (N, 5, 3) grasp keypoints in scene frame
+    n_grasps = len(grasp_points)
     grasp_points = grasp_points.reshape(-1, 3)  # (N*5, 3)
     
-    ray_origins = np.tile(cam_pose[:3, 3], (len(grasp_points), 1))
+    ray_origins = np.broadcast_to(cam_pose[:3, 3], grasp_points.shape)
     ray_directions = grasp_points - ray_origins
-    ray_directions /= np.linalg.norm(ray_directions, axis=1, keepdims=True)
 
-    scene_mesh: trimesh.Trimesh = scene.scene.to_mesh()
-    intersect_points, ray_idxs, _ = scene_mesh.ray.intersects_location(ray_origins, ray_directions)
+    intersect_points, ray_idxs, _ = intersector.intersects_location(ray_origins, ray_directions, multiple_hits=False)
+    hit_offsets = intersect_points - ray_origins[ray_idxs]
+    occluded = np.einsum("ij,ij->i", hit_offsets, hit_offsets) < np.einsum("ij,ij->i", ray_directions[ray_idxs], ray_directions[ray_idxs])
     ray_hit_grasp = np.ones(len(grasp_points), dtype=bool)
-    for i in range(len(ray_hit_grasp)):
-        mask = ray_idxs == i
-        if np.any(mask):
-            points = intersect_points[mask]
-            closest_hit_dist = np.min(np.linalg.norm(points - ray_origins[i], axis=1))
-            grasp_point_dist = np.linalg.norm(grasp_points[i] - ray_origins[i])
-            if closest_hit_dist < grasp_point_dist:
-                ray_hit_grasp[i] = False
-    visible = np.sum(ray_hit_grasp.reshape(len(grasps), len(GRASP_LOCAL_POINTS)), axis=1) >= 3
+    ray_hit_grasp[ray_idxs[occluded]] = False
+    visible = np.sum(ray_hit_grasp.reshape(n_grasps, len(GRASP_LOCAL_POINTS)), axis=1) >= 3
     return visible
 
-def noncolliding_annotations(scene: ss.Scene, annots: list[Annotation], grasps: np.ndarray, collision_cache: dict[tuple[str, str, int], bool]):
+def geometry_aabbs(scene: trimesh.Scene):
+    # (M, 2, 3) world-frame AABB of every geometry node in the scene
+    aabbs = []
+    for node in scene.graph.nodes_geometry:
+        trf, geom_name = scene.graph[node]
+        corners = tra.transform_points(trimesh.bounds.corners(scene.geometry[geom_name].bounds), trf)
+        aabbs.append([corners.min(axis=0), corners.max(axis=0)])
+    return np.array(aabbs).reshape(-1, 2, 3)
+
+def scene_geometry_mesh(scene: trimesh.Scene):
+    # like scene.to_mesh(), but without merging visuals
+    vertices, faces = [], []
+    for node in scene.graph.nodes_geometry:
+        trf, geom_name = scene.graph[node]
+        geom = scene.geometry[geom_name]
+        if isinstance(geom, trimesh.Trimesh):
+            vertices.append(tra.transform_points(geom.vertices, trf))
+            faces.append(geom.faces)
+    vertices, faces = trimesh.util.append_faces(vertices, faces)
+    return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+def scene_collision_manager(scene: trimesh.Scene):
+    # one fcl object per scene geometry, convex geometry as fcl.Convex like trimesh's CollisionManager does,
+    # since a BVH only detects crossing triangles and would miss a gripper fully inside a convex object
+    objs = []
+    for node in scene.graph.nodes_geometry:
+        trf, geom_name = scene.graph[node]
+        geom = scene.geometry[geom_name]
+        if not isinstance(geom, trimesh.Trimesh):
+            continue
+        geom_fcl = trimesh.collision.mesh_to_convex(geom) if geom.is_convex else trimesh.collision.mesh_to_BVH(geom)
+        objs.append(fcl.CollisionObject(geom_fcl, fcl.Transform(trf[:3, :3], trf[:3, 3])))
+    manager = fcl.DynamicAABBTreeCollisionManager()
+    manager.registerObjects(objs)
+    manager.setup()
+    return manager
+
+def noncolliding_annotations(scene: trimesh.Scene, grasps: np.ndarray):
     # grasps is (N, 4, 4) poses in scene frame
-    gripper_manager = trimesh.collision.CollisionManager()
     noncolliding = np.ones(len(grasps), dtype=bool)
-    cache_miss_idxs = []
-    for i, (annot, grasp) in enumerate(zip(annots, grasps)):
-        if (annot.obj.object_category, annot.obj.object_id, annot.grasp_id) in collision_cache:
-            noncolliding[i] = collision_cache[(annot.obj.object_category, annot.obj.object_id, annot.grasp_id)]
-            continue
-        gripper_manager.add_object(f"gripper_{i}", create_gripper_marker(), transform=grasp)
-        cache_miss_idxs.append(i)
-
-    if len(cache_miss_idxs) > 0:
-        _, pairs = scene.in_collision_other(gripper_manager, return_names=True)
-        for pair in pairs:
-            if (name := next(filter(lambda x: x.startswith("gripper_"), pair), None)) is not None:
-                idx = int(name.split("_")[-1])
-                noncolliding[idx] = False
-
-        for i in cache_miss_idxs:
-            collision_cache[(annots[i].obj.object_category, annots[i].obj.object_id, annots[i].grasp_id)] = noncolliding[i]
+
+    # grippers whose AABB overlaps no scene geometry can't collide, so they don't need the narrow phase
+    gripper_corners = np.einsum("pj,nij->npi", GRIPPER_CORNERS_H, grasps[:, :3])  # (N, 8, 3)
+    gripper_aabbs = np.stack([gripper_corners.min(axis=1), gripper_corners.max(axis=1)], axis=1)
+    scene_aabbs = geometry_aabbs(scene)
+    aabb_overlaps = np.all(
+        (gripper_aabbs[:, None, 0] <= scene_aabbs[None, :, 1]) & (gripper_aabbs[:, None, 1] >= scene_aabbs[None, :, 0]),
+        axis=-1
+    )
+    check_idxs = np.flatnonzero(np.any(aabb_overlaps, axis=1))
+
+    if len(check_idxs) > 0:
+        manager = scene_collision_manager(scene)
+        for i in check_idxs:
+            gripper_obj = fcl.CollisionObject(GRIPPER_BVH, fcl.Transform(grasps[i, :3, :3], grasps[i, :3, 3]))
+            cdata = fcl.CollisionData()
+            manager.collide(gripper_obj, cdata, fcl.defaultCollisionCallback)
+            noncolliding[i] = not cdata.result.is_collision
     return noncolliding
 
-def point_on_support(scene: ss.Scene):
+def get_support_surfaces(scene: ss.Scene):
     surfaces = scene.support_generator(sampling_fn=lambda x: x)
-    weights = [s.polygon.area for s in surfaces]
-    weights = np.array(weights) / np.sum(weights)
-    surface = surfaces[np.random.choice(len(surfaces), p=weights)]
+    cum_areas = np.cumsum([s.polygon.area for s in surfaces])
+    surface_trfs = [scene.get_transform(s.node_name)[:-1] @ s.transform for s in surfaces]  # surface to scene frame
+    return surfaces, cum_areas, surface_trfs
+
+def point_on_support(support_surfaces: tuple[list, np.ndarray, list[np.ndarray]]):
+    surfaces, cum_areas, surface_trfs = support_surfaces
+    idx = np.searchsorted(cum_areas, np.random.rand() * cum_areas[-1], side="right")
 
     it = PositionIteratorUniform()
-    x, y = next(it(surface))[0]
+    x, y = next(it(surfaces[idx]))[0]
 
-    obj_pose = scene.get_transform(surface.node_name)
-    return obj_pose[:-1] @ surface.transform @ np.array([x, y, 0, 1])
+    return surface_trfs[idx] @ np.array([x, y, 0, 1])
 
 def sample_camera_pose(
-    scene: ss.Scene,
+    support_surfaces: tuple[list, np.ndarray, list[np.ndarray]],
     datagen_cfg: DatagenConfig,
-    cam_dfov: float,
-    in_scene_annotations: list[Annotation],
+    cam_K: np.ndarray,
+    cam_xfov: float,
+    cam_yfov: float,
+    intersector: trimesh.ray.ray_triangle.RayMeshIntersector,
     annotation_grasps: np.ndarray,
-    collision_cache: dict[tuple[str, str, int], bool]
+    annotation_grasp_points: np.ndarray,
+    candidate_idxs: np.ndarray
 ):
-    img_h, img_w = datagen_cfg.img_size
-    cam_K = construct_cam_K(img_w, img_h, cam_dfov)
-    cam_xfov = 2 * np.arctan(img_w / (2 * cam_K[0, 0]))
-    cam_yfov = 2 * np.arctan(img_h / (2 * cam_K[1, 1]))
-
-    lookat_pos = point_on_support(scene)
+    lookat_pos = point_on_support(support_surfaces)
 
     cam_dist = np.random.uniform(*datagen_cfg.cam_dist_range)
     inclination = np.pi/2 - np.random.uniform(*datagen_cfg.cam_elevation_range)
@@ -274,11 +314,14 @@ def sample_camera_pose(
             datagen_cfg.cam_yaw_perturb * np.radians(cam_xfov)
         )
 
-    in_view_annots, in_view_grasps = get_annotations_in_view(scene, datagen_cfg, cam_K, cam_pose, in_scene_annotations, annotation_grasps, collision_cache)
-    if len(in_view_annots) < datagen_cfg.min_annots_per_view:
+    in_view_idxs = get_annotations_in_view(
+        intersector, datagen_cfg, cam_K, cam_pose, annotation_grasps, annotation_grasp_points, candidate_idxs,
+        min_in_view=datagen_cfg.min_annots_per_view
+    )
+    if len(in_view_idxs) < datagen_cfg.min_annots_per_view:
         return None
 
-    return cam_K, cam_pose, in_view_annots, in_view_grasps
+    return cam_K, cam_pose, in_view_idxs
 
 
 def sample_arrangement(
@@ -288,7 +331,7 @@ def sample_arrangement(
     background_meshes: list[trimesh.Trimesh],
     support_mesh: trimesh.Trimesh,
     object_library: MeshLibrary,
-    annotations: list[Annotation]
+    object_annotations: dict[tuple[str, str], list[Annotation]]
 ):
     scene = ss.Scene()
     scene.add_object(ss.TrimeshAsset(support_mesh, origin=("centroid", "centroid", "bottom")), "support")
@@ -305,7 +348,10 @@ def sample_arrangement(
         objs_placed += scene.place_object(f"object_{category}_{obj_id}", asset, "support")
     if objs_placed <= 1:
         return None
+    support_footprint = np.prod(support_mesh.extents[:2])
     for i, obj in enumerate(background_meshes):
+        if np.prod(obj.extents[:2]) > MAX_BACKGROUND_FOOTPRINT_FRAC * support_footprint:
+            continue
         asset = ss.TrimeshAsset(obj, origin=("centroid", "centroid", "bottom"))
         scene.place_object(f"background_{i}", asset, "support")
 
@@ -318,22 +364,33 @@ def sample_arrangement(
         grasps_dict[(cat, obj_id)] = object_library.grasps(cat, obj_id)[0]
 
     in_scene_annotations: list[Annotation] = []
-    annotation_grasps = []  # grasps in scene frame
-    for annot in annotations:
-        if (annot.obj.object_category, annot.obj.object_id) in grasps_dict:
-            obj_name = f"object_{annot.obj.object_category}_{annot.obj.object_id}"
-            in_scene_annotations.append(annot)
-            grasp_local = grasps_dict[(annot.obj.object_category, annot.obj.object_id)][annot.grasp_id].copy()
-            geom_names = scene.get_geometry_names(obj_name)
-            assert len(geom_names) == 1
-            # the grasp is in the centroid frame of the object, so offset by centroid in local frame
-            grasp_local[:3, 3] += scene.get_centroid(geom_names[0], obj_name)
-            obj_trf = scene.get_transform(obj_name)
-            grasp = obj_trf @ grasp_local  # transform to scene frame
-            annotation_grasps.append(grasp)
-
-    annotation_grasps = np.array(annotation_grasps)
-    collision_cache: dict[tuple[str, str, int], bool] = {}  # (category, obj_id, grasp_id) -> is colliding
+    for key in grasps_dict:
+        in_scene_annotations.extend(object_annotations.get(key, []))
+
+    annotation_grasps = np.empty((len(in_scene_annotations), 4, 4))  # grasps in scene frame
+    start = 0
+    for (cat, obj_id), grasps in grasps_dict.items():
+        annots = object_annotations.get((cat, obj_id), [])
+        if len(annots) == 0:
+            continue
+        obj_name = f"object_{cat}_{obj_id}"
+        grasps_local = grasps[[annot.grasp_id for annot in annots]]
+        geom_names = scene.get_geometry_names(obj_name)
+        assert len(geom_names) == 1
+        # the grasps are in the centroid frame of the object, so offset by centroid in local frame
+        grasps_local[:, :3, 3] += scene.get_centroid(geom_names[0], obj_name)
+        obj_trf = scene.get_transform(obj_name)
+        np.matmul(obj_trf, grasps_local, out=annotation_grasps[start:start + len(annots)])  # transform to scene frame
+        start += len(annots)
+
+    annotation_grasp_points = np.einsum("pj,nij->npi", GRASP_LOCAL_POINTS_H, annotation_grasps[:, :3])  # (N, 5, 3)
+
+    candidate_idxs = np.flatnonzero(noncolliding_annotations(scene.scene, annotation_grasps))
+    if len(candidate_idxs) < datagen_cfg.min_annots_per_view:
+        return None
+    scene_mesh = scene_geometry_mesh(scene.scene)
+    intersector = scene_mesh.ray
+    support_surfaces = get_support_surfaces(scene)
 
     views: list[tuple[np.ndarray, np.ndarray]] = []
     annots_in_scene: dict[str, tuple[Annotation, np.ndarray]] = {}  # annotation_id -> (annotation, grasp)
@@ -341,23 +398,28 @@ def sample_arrangement(
     try:
         for i in range(datagen_cfg.n_views):
             cam_dfov = np.random.uniform(*datagen_cfg.cam_dfov_range)
-            cam_K, cam_pose, in_view_annots, in_view_grasps = rejection_sample(
-                lambda: sample_camera_pose(scene, datagen_cfg, cam_dfov, in_scene_annotations, annotation_grasps, collision_cache),
+            img_h, img_w = datagen_cfg.img_size
+            cam_K = construct_cam_K(img_w, img_h, cam_dfov)
+            cam_xfov = 2 * np.arctan(img_w / (2 * cam_K[0, 0]))
+            cam_yfov = 2 * np.arctan(img_h / (2 * cam_K[1, 1]))
+            cam_K, cam_pose, in_view_idxs = rejection_sample(
+                lambda: sample_camera_pose(support_surfaces, datagen_cfg, cam_K, cam_xfov, cam_yfov, intersector, annotation_grasps, annotation_grasp_points, candidate_idxs),
                 not_none,
                 100
             )
             views.append([cam_K, cam_pose])
             annots_per_view.append([])
-            for annot, grasp in zip(in_view_annots, in_view_grasps):
+            for idx in in_view_idxs:
+                annot = in_scene_annotations[idx]
                 annot_id = f"{annot.obj.object_category}_{annot.obj.object_id}_{annot.grasp_id}"
-                annots_in_scene[annot_id] = (annot, grasp)
+                annots_in_scene[annot_id] = (annot, annotation_grasps[idx])
                 annots_per_view[-1].append(annot_id)
     except RejectionSampleError:
         return None
 
     return scene, views, annots_in_scene, annots_per_view
 
-def sample_scene(datagen_cfg: DatagenConfig, annotations: list[Annotation], object_library: MeshLibrary, background_library: MeshLibrary, support_library: MeshLibrary):
+def sample_scene(datagen_cfg: DatagenConfig, object_annotations: dict[tuple[str, str], list[Annotation]], object_library: MeshLibrary, background_library: MeshLibrary, support_library: MeshLibrary):
     n_objects = min(np.random.randint(*datagen_cfg.n_objects_range), len(object_library.categories()))
     n_background = min(np.random.randint(*datagen_cfg.n_background_range), len(background_library.categories()))
 
@@ -367,7 +429,7 @@ def sample_scene(datagen_cfg: DatagenConfig, annotations: list[Annotation], obje
 
     try:
         return rejection_sample(
-            lambda: sample_arrangement(datagen_cfg, object_keys, object_meshes, background_meshes, support_mesh, object_library, annotations),
+            lambda: sample_arrangement(datagen_cfg, object_keys, object_meshes, background_meshes, support_mesh, object_library, object_annotations),
             not_none,
             10
         )
@@ -375,37 +437,35 @@ def sample_scene(datagen_cfg: DatagenConfig, annotations: list[Annotation], obje
         return None
 
 def get_annotations_in_view(
-    scene: ss.Scene,
+    intersector: trimesh.ray.ray_triangle.RayMeshIntersector,
     datagen_cfg: DatagenConfig,
     cam_K: np.ndarray,
     cam_pose: np.ndarray,
-    in_scene_annotations: list[Annotation],
     annotation_grasps: np.ndarray,
-    collision_cache: dict[tuple[str, str, int], bool]
+    annotation_grasp_points: np.ndarray,
+    candidate_idxs: np.ndarray,
+    min_in_view: int = 1
 ):
     """
     Returns:
-        in_view_annots: list[Annotation] - annotations in view
-        in_view_grasps: np.ndarray - grasps in scene frame
+        in_view_idxs: np.ndarray - indices of the in-scene annotations that are in view,
+            empty if fewer than min_in_view are
     """
-    in_view_annots = in_scene_annotations
-    in_view_grasps = annotation_grasps
+    in_view_idxs = candidate_idxs
     for mask_fn in [
-        lambda grasps: on_screen_annotations(datagen_cfg, cam_K, cam_pose, grasps),
-        lambda grasps: noncolliding_annotations(scene, in_scene_annotations, grasps, collision_cache),
-        lambda grasps: visible_annotations(scene, cam_pose, grasps)
+        lambda idxs: close_annotations(datagen_cfg, cam_pose, annotation_grasps[idxs]),
+        lambda idxs: on_screen_annotations(datagen_cfg, cam_K, cam_pose, annotation_grasp_points[idxs]),
+        lambda idxs: visible_annotations(intersector, cam_pose, annotation_grasp_points[idxs])
     ]:
-        mask = mask_fn(in_view_grasps)
-        in_view_annots = list(compress(in_view_annots, mask))
-        in_view_grasps = in_view_grasps[mask]
-        if not np.any(mask):
-            break
+        in_view_idxs = in_view_idxs[mask_fn(in_view_idxs)]
+        if len(in_view_idxs) < max(min_in_view, 1):
+            return in_view_idxs[:0]
     
-    return in_view_annots, in_view_grasps
+    return in_view_idxs
 
-def generate_scene(datagen_cfg: DatagenConfig, annotations: list[Annotation], object_library: MeshLibrary, background_library: MeshLibrary, support_library: MeshLibrary):
+def generate_scene(datagen_cfg: DatagenConfig, object_annotations: dict[tuple[str, str], list[Annotation]], object_library: MeshLibrary, background_library: MeshLibrary, support_library: MeshLibrary):
     scene, views, annots_in_scene, annots_per_view = rejection_sample(
-        lambda: sample_scene(datagen_cfg, annotations, object_library, background_library, support_library),
+        lambda: sample_scene(datagen_cfg, object_annotations, object_library, background_library, support_library),
         not_none,
         -1
     )
@@ -417,7 +477,7 @@ def generate_scene(datagen_cfg: DatagenConfig, annotations: list[Annotation], ob
         "annotations": annots_in_scene,
         "views": [],
         "lighting": lighting,
-        "glb": base64.b64encode(glb_bytes).decode("utf-8"),
+        "glb": glb_bytes,
         "img_size": datagen_cfg.img_size
     }
     for (cam_K, cam_pose), annots in zip(views, annots_per_view):
@@ -428,6 +488,12 @@ def generate_scene(datagen_cfg: DatagenConfig, annotations: list[Annotation], ob
         })
     return data, scene
 
+def group_annotations(annotations: list[Annotation]):
+    object_annotations: dict[tuple[str, str], list[Annotation]] = {}
+    for annot in annotations:
+        object_annotations.setdefault((annot.obj.object_category, annot.obj.object_id), []).append(annot)
+    return object_annotations
+
 def procgen_init():
     annotations: list[Annotation] = []
     for annot_fn in os.listdir(ANNOTATIONS_DIR):
@@ -440,7 +506,7 @@ def procgen_init():
             annotated_instances[annot.obj.object_category] = set()
         annotated_instances[annot.obj.object_category].add(annot.obj.object_id)
 
-    globals()["annotations"] = annotations
+    globals()["object_annotations"] = group_annotations(annotations)
     globals()["object_library"] = MeshLibrary(annotated_instances)
     background_categories = [cat for cat in ALL_OBJECT_CATEGORIES if cat not in annotated_instances]
     globals()["background_library"] = MeshLibrary.from_categories(background_categories)
@@ -457,7 +523,7 @@ def procgen_init():
 def procgen_worker(datagen_cfg: DatagenConfig, out_dir: str):
     data, scene = generate_scene(
         datagen_cfg,
-        globals()["annotations"],
+        globals()["object_annotations"],
         globals()["object_library"],
         globals()["background_library"],
         globals()["support_library"]
@@ -511,19 +577,14 @@ def main():
     nproc = args.n_proc or os.cpu_count()
     with ProcessPoolExecutor(max_workers=nproc, initializer=procgen_init) as executor:
         with tqdm(total=args.n_samples, desc="Generating scenes", dynamic_ncols=True, initial=n_existing_samples) as pbar:
-            futures: list[Future] = []
+            futures: set[Future] = set()
             try:
                 for _ in range(n_samples):
-                    n_not_done = sum(not f.done() for f in futures)
-                    if n_not_done < 4 * nproc:
-                        futures.append(executor.submit(procgen_worker, datagen_cfg, args.out_dir))
-                    else:
-                        time.sleep(0.5)
-
-                    new_futures = [f for f in futures if not f.done()]
-                    if len(new_futures) < len(futures):
-                        pbar.update(len(futures) - len(new_futures))
-                        futures = new_futures
+                    # keep at most 4 * nproc scenes in flight, blocking until one finishes
+                    if len(futures) >= 4 * nproc:
+                        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                        pbar.update(len(done))
+                    futures.add(executor.submit(procgen_worker, datagen_cfg, args.out_dir))
                 print("Waiting for remaining subprocesses to finish")
                 if len(futures) > 0:
                     for _ in as_completed(futures):
@@ -554,7 +615,7 @@ def main_test():
 
     datagen_cfg = DatagenConfig()
 
-    data, _ = generate_scene(datagen_cfg, annotations, object_library, background_library, support_library)
+    data, _ = generate_scene(datagen_cfg, group_annotations(annotations), object_library, background_library, support_library)
     with open("tmp/scene.pkl", "wb") as f:
         pickle.dump(data, f)
 
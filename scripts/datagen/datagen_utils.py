@@ -1,9 +1,15 @@
 import os
 import json
+import math
+import random
+import pickle
+import hashlib
+import tempfile
 from typing import Any, Callable, TypeVar
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import h5py
 import numpy as np
-from scipy.spatial.transform import Rotation as R
 import trimesh
 from multiprocessing import Event
 from itertools import count
@@ -39,18 +45,24 @@ def rejection_sample(sampler_fn: Callable[[], U], condition_fn: Callable[[U], bo
             return sample
     raise RejectionSampleError("Failed to sample")
 
-def kelvin_to_rgb(kelvin: float):
+def kelvin_to_rgb(kelvin: float | np.ndarray):
     # taken from: https://tannerhelland.com/2012/09/18/convert-temperature-rgb-algorithm-code.html
-    temp = kelvin / 100
-    if temp <= 66:
-        r = 255
-        g = np.clip(99.4708025861 * np.log(temp) - 161.1195681661, 0, 255)
-        b = np.clip(138.5177312231 * np.log(temp - 10) - 305.0447927307, 0, 255) if temp > 19 else 0
-    else:
-        r = np.clip(329.698727446 * np.power(temp - 60, -0.1332047592), 0, 255)
-        g = np.clip(288.1221695283 * np.power(temp - 60, -0.0755148492), 0, 255)
-        b = 255
-    return np.array([r, g, b])
+    # both branches are evaluated, so their inputs are clamped to stay in the log/pow domains
+    temp = np.asarray(kelvin, dtype=np.float64) / 100
+    low = temp <= 66
+    high_temp = np.maximum(temp - 60, 1e-9)
+    r = np.where(low, 255, np.clip(329.698727446 * np.power(high_temp, -0.1332047592), 0, 255))
+    g = np.where(
+        low,
+        np.clip(99.4708025861 * np.log(np.maximum(temp, 1e-9)) - 161.1195681661, 0, 255),
+        np.clip(288.1221695283 * np.power(high_temp, -0.0755148492), 0, 255)
+    )
+    b = np.where(
+        low,
+        np.where(temp > 19, np.clip(138.5177312231 * np.log(np.maximum(temp - 10, 1e-9)) - 305.0447927307, 0, 255), 0),
+        255
+    )
+    return np.stack([r, g, b], axis=-1)
 
 def load_annotation(path: str):
     with open(path) as f:
@@ -62,16 +74,22 @@ def load_annotation(path: str):
     return data
 
 def look_at_rot(p1: np.ndarray, p2: np.ndarray):
-    z = -(p2 - p1)
-    z /= np.linalg.norm(z)
-    x = np.cross(z, np.array([0, 0, -1]))
-    x /= np.linalg.norm(x)
-    y = np.cross(z, x)
-    y /= np.linalg.norm(y)
-    return np.column_stack((x, y, z))
+    zx, zy, zz = (float(a - b) for a, b in zip(p1, p2))
+    z_norm = math.sqrt(zx * zx + zy * zy + zz * zz)
+    zx, zy, zz = zx / z_norm, zy / z_norm, zz / z_norm
+    # x = z cross [0, 0, -1]
+    x_norm = math.hypot(zx, zy)
+    xx, xy = -zy / x_norm, zx / x_norm
+    # y = z cross x, already unit length since z and x are orthonormal
+    yx, yy, yz = -zz * xy, zz * xx, zx * xy - zy * xx
+    return np.array([
+        [xx, yx, zx],
+        [xy, yy, zy],
+        [0.0, yz, zz]
+    ])
 
 def construct_cam_K(w: int, h: int, dfov: float):
-    f = (np.hypot(w, h) / 2) / np.tan(np.radians(dfov/2))
+    f = (math.hypot(w, h) / 2) / math.tan(math.radians(dfov/2))
     cam_info = np.array([
         [f, 0, w/2],
         [0, f, h/2],
@@ -79,16 +97,38 @@ def construct_cam_K(w: int, h: int, dfov: float):
     ])
     return cam_info
 
+def inv_transform(trf: np.ndarray):
+    # inverse of rigid (..., 4, 4) transforms, [R | t]^-1 = [R^T | -R^T t]
+    rot_t = np.swapaxes(trf[..., :3, :3], -1, -2)
+    inv = np.zeros_like(trf)
+    inv[..., :3, :3] = rot_t
+    inv[..., :3, 3] = -(rot_t @ trf[..., :3, 3:])[..., 0]
+    inv[..., 3, 3] = 1
+    return inv
+
 def random_delta_rot(roll_range: float, pitch_range: float, yaw_range: float):
-    roll = np.random.uniform(-roll_range, roll_range)
-    pitch = np.random.uniform(-pitch_range, pitch_range)
-    yaw = np.random.uniform(-yaw_range, yaw_range)
-    return R.from_euler("xyz", [roll, pitch, yaw]).as_matrix()
+    roll = random.uniform(-roll_range, roll_range)
+    pitch = random.uniform(-pitch_range, pitch_range)
+    yaw = random.uniform(-yaw_range, yaw_range)
+    # extrinsic xyz euler angles, i.e. Rz(yaw) @ Ry(pitch) @ Rx(roll)
+    cr, sr = math.cos(roll), math.sin(roll)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    return np.array([
+        [cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr],
+        [sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr],
+        [-sp, cp * sr, cp * cr]
+    ])
+
+MESH_CACHE_DIR = "data/mesh_cache"
+MESH_LOAD_EXECUTOR = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
 
 class MeshLibrary(object):
     def __init__(self, library: dict[str, set[str]], load_kwargs: dict | None = None):
         self.library = library
         self.load_kwargs = load_kwargs or {}
+        self._category_list = tuple(self.library.keys())
+        self._object_lists = {category: tuple(obj_ids) for category, obj_ids in self.library.items()}
 
     @classmethod
     def from_categories(cls, categories: list[str], load_kwargs: dict | None = None):
@@ -129,20 +169,42 @@ class MeshLibrary(object):
 
     def sample(self, n_categories: int | None = None, replace=False):
         ret_keys: list[tuple[str, str]] = []
-        ret_meshes: list[trimesh.Trimesh] = []
-        categories = np.random.choice(list(self.library.keys()), size=n_categories or 1, replace=replace)
+        n = n_categories or 1
+        categories = random.choices(self._category_list, k=n) if replace else random.sample(self._category_list, n)
         for category in categories:
-            obj_id = np.random.choice(list(self.library[category]))
-            ret_keys.append((category, obj_id))
-            ret_meshes.append(self[category, obj_id])
+            ret_keys.append((category, random.choice(self._object_lists[category])))
+        ret_meshes: list[trimesh.Trimesh] = list(MESH_LOAD_EXECUTOR.map(self.__getitem__, ret_keys))
         return (ret_keys, ret_meshes) if n_categories else (ret_keys[0], ret_meshes[0])
 
     @lru_cache(maxsize=2048)
     def _load_mesh(self, category: str, obj_id: str, center: bool = True):
+        kwargs_hash = hashlib.md5(repr(sorted(self.load_kwargs.items())).encode()).hexdigest()[:8]
+        cache_path = f"{MESH_CACHE_DIR}/{category}_{obj_id}_{kwargs_hash}_{int(center)}.pkl"
         fn = f"data/grasps/{category}_{obj_id}.h5"
+        if os.path.isfile(cache_path):
+            with open(cache_path, "rb") as f:
+                source_mtimes, mesh = pickle.load(f)
+            # only valid while the files it was parsed from are unchanged, e.g. not re-downloaded
+            if all(os.path.isfile(path) and os.stat(path).st_mtime_ns == mtime for path, mtime in source_mtimes.items()):
+                return mesh
+
+        with h5py.File(fn, "r") as data:
+            mesh_fn = os.path.join("data", data["object/file"][()].decode("utf-8"))
+        # stat before loading, so a file modified mid-load makes the cache entry stale rather than wrong
+        source_mtimes = {path: os.stat(path).st_mtime_ns for path in (fn, mesh_fn)}
         mesh = load_mesh(fn, mesh_root_dir="data", **self.load_kwargs)
         if center:
             mesh.apply_translation(-mesh.centroid)
+
+        os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=MESH_CACHE_DIR, suffix=".tmp", delete=False) as f:
+            try:
+                pickle.dump((source_mtimes, mesh), f)
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, cache_path)
         return mesh
 
     @lru_cache(maxsize=2048)
@@ -1,5 +1,5 @@
 import argparse
-from concurrent.futures import ProcessPoolExecutor, as_completed, Future
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 import multiprocessing as mp
 from io import BytesIO
 import os
@@ -8,6 +8,7 @@ import random
 import time
 from base64 import b64decode
 from contextlib import contextmanager
+from functools import lru_cache
 import signal
 
 import yaml
@@ -25,8 +26,7 @@ import pyrender.light
 import trimesh
 from PIL import Image
 
-import datagen_utils
-assert datagen_utils  # imported for modification to path
+from datagen_utils import inv_transform  # also modifies path
 from annotation import Annotation
 
 def get_args():
@@ -61,8 +61,13 @@ def worker_init(img_size: tuple[int, int]):
     renderer = pyrender.OffscreenRenderer(width, height)
     globals()["renderer"] = renderer
 
+    globals()["cam_node"] = pyrender.Node(name="camera", camera=pyrender.camera.IntrinsicsCamera(fx=1, fy=1, cx=0, cy=0, name="camera"))
+    globals()["cam_light_node"] = pyrender.Node(name="camera_light", light=pyrender.light.PointLight(intensity=2.0, name="camera_light"))
+
 def build_scene(data: dict[str, any]):
-    glb_bytes = BytesIO(b64decode(data["glb"].encode("utf-8")))
+    glb = data["glb"]
+    # older scenes stored the GLB base64-encoded
+    glb_bytes = BytesIO(glb if isinstance(glb, bytes) else b64decode(glb.encode("utf-8")))
     tr_scene: trimesh.Scene = trimesh.load(glb_bytes, file_type="glb")
     scene = pyrender.Scene.from_trimesh_scene(tr_scene)
 
@@ -72,33 +77,33 @@ def build_scene(data: dict[str, any]):
         light_args["color"] = np.array(light_args["color"]) / 255.0
         light_node = pyrender.Node(light["args"]["name"], matrix=light["transform"], light=light_type(**light_args))
         scene.add_node(light_node)
+
+    scene.add_node(globals()["cam_node"])
+    scene.add_node(globals()["cam_light_node"])
     return scene
 
 def set_camera(scene: pyrender.Scene, cam_K: np.ndarray, cam_pose: np.ndarray):
-    cam = pyrender.camera.IntrinsicsCamera(
-        fx=cam_K[0, 0],
-        fy=cam_K[1, 1],
-        cx=cam_K[0, 2],
-        cy=cam_K[1, 2],
-        name="camera",
-    )
-    cam_node = pyrender.Node(name="camera", camera=cam, matrix=cam_pose)
-    for n in (scene.get_nodes(name=cam_node.name) or []):
-        scene.remove_node(n)
-    scene.add_node(cam_node)
-
-    cam_light = pyrender.light.PointLight(intensity=2.0, name="camera_light")
-    camera_light_node = pyrender.Node(name="camera_light", matrix=cam_pose, light=cam_light)
-    for n in (scene.get_nodes(name=camera_light_node.name) or []):
-        scene.remove_node(n)
-    scene.add_node(camera_light_node)
+    cam_node: pyrender.Node = globals()["cam_node"]
+    cam: pyrender.camera.IntrinsicsCamera = cam_node.camera
+    cam.fx = cam_K[0, 0]
+    cam.fy = cam_K[1, 1]
+    cam.cx = cam_K[0, 2]
+    cam.cy = cam_K[1, 2]
+    scene.set_pose(cam_node, cam_pose)
+    scene.set_pose(globals()["cam_light_node"], cam_pose)
+
+@lru_cache(maxsize=8)
+def ray_table(fx: float, fy: float, cx: float, cy: float, height: int, width: int):
+    # K^-1 [u, v, 1]^T for every pixel, i.e. the camera-frame point at unit depth
+    u, v = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32), indexing="xy")
+    rays = np.stack(((u - cx) / fx, (v - cy) / fy, np.ones_like(u)), axis=-1)
+    rays.flags.writeable = False
+    return rays
 
 def backproject(cam_K: np.ndarray, depth: np.ndarray):
     height, width = depth.shape
-    u, v = np.meshgrid(np.arange(width), np.arange(height), indexing="xy")
-    uvd = np.stack((u, v, np.ones_like(u)), axis=-1).astype(np.float32)
-    uvd *= np.expand_dims(depth, axis=-1)
-    xyz = uvd @ np.expand_dims(np.linalg.inv(cam_K).T, axis=0)
+    rays = ray_table(float(cam_K[0, 0]), float(cam_K[1, 1]), float(cam_K[0, 2]), float(cam_K[1, 2]), height, width)
+    xyz = rays * np.expand_dims(depth, axis=-1)
     return xyz
 
 def render(out_dir: str, scene_dir: str):
@@ -115,46 +120,43 @@ def render(out_dir: str, scene_dir: str):
     scene = build_scene(scene_data)
 
     renderer: pyrender.OffscreenRenderer = globals()["renderer"]
-    renderer.viewport_height, renderer.viewport_width = scene_data["img_size"]
+    if (renderer.viewport_height, renderer.viewport_width) != tuple(scene_data["img_size"]):
+        renderer.viewport_height, renderer.viewport_width = scene_data["img_size"]
 
-    obs_per_view: list[list[tuple[dict, Annotation, str]]] = []
-    rgb_per_view: list[np.ndarray] = []
+    # the rgb and xyz are shared by every observation in a view, so they're stored once per view
+    view_data: list[tuple[np.ndarray, np.ndarray, np.ndarray, list[dict]]] = []
     for view in scene_data["views"]:
-        cam_K = np.array(view["cam_K"])
-        cam_pose = np.array(view["cam_pose"])
+        cam_K = np.asarray(view["cam_K"])
+        cam_pose = np.asarray(view["cam_pose"])
         set_camera(scene, cam_K, cam_pose)
 
         color, depth = renderer.render(scene, flags=pyrender.RenderFlags.SHADOWS_DIRECTIONAL)
         xyz = backproject(cam_K, depth)
-        rgb_per_view.append(color)
-        obs = []
-        for annot_id in view["annotations_in_view"]:
+        grasp_poses = np.empty((len(view["annotations_in_view"]), 4, 4))
+        annots = []
+        for obs_idx, annot_id in enumerate(view["annotations_in_view"]):
             annot, grasp_pose = all_annotations[annot_id]
-            grasp_pose_in_cam_frame = np.linalg.solve(cam_pose, grasp_pose)
-            obs_data = {
-                "rgb": color,
-                "xyz": xyz,
-                "grasp_pose": grasp_pose_in_cam_frame,
-            }
-            # obs.append(pickle.dumps(obs_data))
-            obs.append((obs_data, annot, annot_id))
-        obs_per_view.append(obs)
+            grasp_poses[obs_idx] = grasp_pose
+            annots.append({
+                "annotation_id": annot_id,
+                "annotation": annot.grasp_description
+            })
+        grasp_poses = inv_transform(cam_pose) @ grasp_poses
+        view_data.append((color, xyz, grasp_poses, annots))
 
     with block_signals([signal.SIGINT]):
-        for view_idx, (rgb, obs) in enumerate(zip(rgb_per_view, obs_per_view)):
+        for view_idx, (rgb, xyz, grasp_poses, annots) in enumerate(view_data):
             view_dir = f"{out_dir}/{scene_id}/view_{view_idx}"
             os.makedirs(view_dir, exist_ok=True)
             Image.fromarray(rgb).save(f"{view_dir}/rgb.png")
-            for obs_idx, (obs_data, annot, annot_id) in enumerate(obs):
-                obs_dir = f"{view_dir}/obs_{obs_idx}"
-                os.makedirs(obs_dir, exist_ok=True)
-                with open(f"{obs_dir}/obs.pkl", "wb") as f:
-                    pickle.dump(obs_data, f)
-                with open(f"{obs_dir}/annot.yaml", "w") as f:
-                    yaml.dump({
-                        "annotation_id": annot_id,
-                        "annotation": annot.grasp_description
-                    }, f)
+            # observation i of this view is (rgb, xyz, grasp_poses[i]) with text annots[i]
+            np.savez_compressed(f"{view_dir}/obs.npz", rgb=rgb, xyz=xyz, grasp_poses=grasp_poses)
+            with open(f"{view_dir}/annot.yaml", "w") as f:
+                yaml.dump(annots, f)
+
+def list_subdirs(path: str) -> set[str]:
+    with os.scandir(path) as it:
+        return set(entry.name for entry in it if entry.is_dir())
 
 class DummyExecutor:
     def __init__(self, initializer, initargs, **kwargs):
@@ -177,31 +179,36 @@ def main():
         max_workers=nproc,
         initializer=worker_init,
         initargs=(args.img_size,)
-    ) as executor:
+    ) as executor, tqdm(desc="Rendering", dynamic_ncols=True, smoothing=0) as pbar:
+        in_flight: dict[Future, str] = {}
+        pending: list[str] = []
         while True:
-            scenes: set[str] = set(fn for fn in os.listdir(args.input_dir) if os.path.isdir(f"{args.input_dir}/{fn}"))
-            processed_scenes: set[str] = set(fn for fn in os.listdir(args.output_dir) if os.path.isdir(f"{args.output_dir}/{fn}"))
-            print(f"Total generated observations: {len(processed_scenes)}")
-
-            if args.n_scenes and len(processed_scenes) >= args.n_scenes:
-                print("Generated enough samples, exiting")
-                break
-
-            batch = list(scenes - processed_scenes)
-            if len(batch) == 0:
-                print("No new scenes, waiting...")
-                time.sleep(60)
-                continue
-            random.shuffle(batch)  # shuffled to avoid different workers processing the same scenes
-            batch = batch[:min(len(batch), 4 * nproc)]
-
-            futures: list[Future] = []
-            # if not multiproc, work happens here - otherwise happens in next loop
-            for fn in tqdm(batch, desc="Rendering", dynamic_ncols=True, disable=multiproc):
-                futures.append(executor.submit(render, args.output_dir, f"{args.input_dir}/{fn}"))
-            if multiproc:
-                for f in tqdm(as_completed(futures), total=len(futures), desc="Rendering", dynamic_ncols=True, smoothing=0):
-                    f.result()
+            if len(pending) == 0:
+                scenes = list_subdirs(args.input_dir)
+                processed_scenes = list_subdirs(args.output_dir)
+                print(f"Total generated observations: {len(processed_scenes)}")
+
+                if args.n_scenes and len(processed_scenes) >= args.n_scenes:
+                    print("Generated enough samples, exiting")
+                    break
+
+                pending = list(scenes - processed_scenes - set(in_flight.values()))
+                random.shuffle(pending)  # shuffled to avoid different workers processing the same scenes
+                pending = pending[:4 * nproc]
+                if len(pending) == 0 and len(in_flight) == 0:
+                    print("No new scenes, waiting...")
+                    time.sleep(60)
+                    continue
+
+            while len(pending) > 0 and len(in_flight) < 2 * nproc:
+                fn = pending.pop()
+                in_flight[executor.submit(render, args.output_dir, f"{args.input_dir}/{fn}")] = fn
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for f in done:
+                del in_flight[f]
+                f.result()
+                pbar.update(1)
 
 if __name__ == "__main__":
     main()
@@ -21,7 +21,7 @@ result = Image.new("RGB", (640 * 3, 480 * 3))
 with open("tmp/scene.pkl", "rb") as f:
     data = pickle.load(f)
 
-glb_bytes = base64.b64decode(data["glb"].encode("utf-8"))
+glb_bytes = data["glb"] if isinstance(data["glb"], bytes) else base64.b64decode(data["glb"].encode("utf-8"))
 glb_bytes_io = io.BytesIO(glb_bytes)
 tr_scene: trimesh.Scene = trimesh.load(glb_bytes_io, file_type="glb")
 scene = pyrender.Scene.from_trimesh_scene(tr_scene)
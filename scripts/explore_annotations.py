@@ -1,65 +1,71 @@
 import os
 import json
-from tempfile import TemporaryDirectory
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import h5py
 import boto3
+from botocore.config import Config
 import matplotlib.pyplot as plt
 import trimesh
 import numpy as np
+from pydantic import ValidationError
 from tqdm import tqdm
 
 from acronym_tools import create_gripper_marker
 from annotation import Annotation, GraspLabel
+from utils import list_s3_files
 
-s3 = boto3.client("s3")
+N_DOWNLOAD_THREADS = 32
+# boto3 clients are thread-safe, size the connection pool so every download thread gets a connection
+s3 = boto3.client("s3", config=Config(max_pool_connections=N_DOWNLOAD_THREADS, retries={"max_attempts": 10, "mode": "adaptive"}))
 BUCKET_NAME = "prior-datasets"
 DATA_PREFIX = "semantic-grasping/acronym/"
+CACHE_DIR = os.path.expanduser("~/.cache/acronym")
 
 def download_annotations(local_dir: str, annotation_prefix: str):
     if not os.path.exists(local_dir):
         os.makedirs(local_dir)
 
     files_to_download = []
-    continuation_token = None
-    while True:
-        list_kwargs = {"Bucket": BUCKET_NAME, "Prefix": annotation_prefix}
-        if continuation_token:
-            list_kwargs["ContinuationToken"] = continuation_token
-        response = s3.list_objects_v2(**list_kwargs)
-
-        if "Contents" in response:
-            for obj in response["Contents"]:
-                key = obj["Key"]
-                if key.endswith(".json"):
-                    local_path = os.path.join(local_dir, os.path.basename(key))
-                    if not os.path.exists(local_path):
-                        files_to_download.append((key, local_path))
-
-        if response.get("IsTruncated"):
-            continuation_token = response["NextContinuationToken"]
-        else:
-            break
-
-    for key, local_path in tqdm(files_to_download, desc="Downloading annotations", disable=len(files_to_download) == 0):
-        s3.download_file(BUCKET_NAME, key, local_path)
+    for key in list_s3_files(s3, BUCKET_NAME, annotation_prefix):
+        local_path = os.path.join(local_dir, os.path.basename(key))
+        if not os.path.exists(local_path):
+            files_to_download.append((key, local_path))
+
+    # the files are small, so this is bound by request latency and the downloads are overlapped
+    with ThreadPoolExecutor(max_workers=N_DOWNLOAD_THREADS) as executor:
+        futures = [executor.submit(s3.download_file, BUCKET_NAME, key, local_path) for key, local_path in files_to_download]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading annotations", disable=len(futures) == 0):
+            future.result()
+
+def load_annotation(path: str):
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        # parse and validate straight from bytes in pydantic-core, without an intermediate dict
+        return Annotation.model_validate_json(raw)
+    except ValidationError:
+        # older annotations used is_grasp_invalid instead of grasp_label
+        data = json.loads(raw)
+        if "is_grasp_invalid" not in data:
+            raise
+        data["grasp_label"] = GraspLabel.INFEASIBLE if data["is_grasp_invalid"] else GraspLabel.BAD
+        del data["is_grasp_invalid"]
+        return Annotation(**data)
 
 def process_annotations(local_dir: str):
-    annotations = []
-    for filename in os.listdir(local_dir):
-        if filename.endswith(".json"):
-            with open(os.path.join(local_dir, filename), "r") as f:
-                data = json.load(f)
-                if "is_grasp_invalid" in data:
-                    data["grasp_label"] = GraspLabel.INFEASIBLE if data["is_grasp_invalid"] else GraspLabel.BAD
-                    del data["is_grasp_invalid"]
-                data = Annotation(**data)
-                annotations.append(data)
+    with os.scandir(local_dir) as it:
+        paths = [entry.path for entry in it if entry.name.endswith(".json")]
+    # each file is tiny, so hand them to workers in chunks to amortize the IPC
+    with ProcessPoolExecutor() as executor:
+        annotations = list(executor.map(load_annotation, paths, chunksize=64))
     return annotations
 
 def plot_time_taken_histogram(annotations):
-    times = [annotation.time_taken / 60 for annotation in annotations if annotation.time_taken >= 0]
+    time_taken = np.fromiter((annotation.time_taken for annotation in annotations), dtype=np.float64, count=len(annotations))
+    times = time_taken[time_taken >= 0] / 60
     plt.hist(times, bins=20)
     plt.xlabel("Time Taken (min)")
     plt.ylabel("Frequency")
@@ -71,37 +77,45 @@ def plot_time_taken_histogram(annotations):
     plt.legend()
     plt.show()
 
+def download_cached(key: str, path: str):
+    # downloads go to a temp file first, so a file at path is always complete
+    if not os.path.exists(path):
+        s3.download_file(BUCKET_NAME, key, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
 def load_object_data(category: str, obj_id: str) -> tuple[trimesh.Scene, np.ndarray]:
     datafile_key = f"{DATA_PREFIX}grasps/{category}_{obj_id}.h5"
-    with TemporaryDirectory() as tmpdir:
-        datafile_path = os.path.join(tmpdir, "data.h5")
-        s3.download_file(BUCKET_NAME, datafile_key, datafile_path)
-        with h5py.File(datafile_path, "r") as f:
-            mesh_fname: str = f["object/file"][()].decode("utf-8")
-            mtl_fname = mesh_fname[:-len(".obj")] + ".mtl"
-            mesh_path = os.path.join(tmpdir, os.path.basename(mesh_fname))
-            mtl_path = os.path.join(tmpdir, os.path.basename(mtl_fname))
-            mesh_pfx = DATA_PREFIX + os.path.dirname(mesh_fname) + "/"
-            s3.download_file(BUCKET_NAME, f"{DATA_PREFIX}{mesh_fname}", mesh_path)
-            s3.download_file(BUCKET_NAME, f"{DATA_PREFIX}{mtl_fname}", mtl_path)
-            with open(mtl_path, "r") as mtl_f:
-                for line in mtl_f.read().splitlines():
-                    if m := re.fullmatch(r".+ (.+\.jpg)", line):
-                        texture_fname = m.group(1)
-                        assert texture_fname == os.path.basename(texture_fname), texture_fname
-                        texture_path = os.path.join(tmpdir, texture_fname)
-                        s3.download_file(BUCKET_NAME, f"{mesh_pfx}{texture_fname}", texture_path)
-
-            T = np.array(f["grasps/transforms"])
-            mesh_scale = f["object/scale"][()]
-        obj_mesh = trimesh.load(mesh_path)
-        obj_mesh = obj_mesh.apply_scale(mesh_scale)
-        if isinstance(obj_mesh, trimesh.Scene):
-            scene = obj_mesh
-        elif isinstance(obj_mesh, trimesh.Trimesh):
-            scene = trimesh.Scene([obj_mesh])
-        else:
-            raise ValueError("Unsupported geometry type")
+    # objects are kept across runs, since the same object is often visualized many times
+    obj_cache = os.path.join(CACHE_DIR, category, obj_id)
+    os.makedirs(obj_cache, exist_ok=True)
+    datafile_path = os.path.join(obj_cache, "data.h5")
+    download_cached(datafile_key, datafile_path)
+    with h5py.File(datafile_path, "r") as f:
+        mesh_fname: str = f["object/file"][()].decode("utf-8")
+        mtl_fname = mesh_fname[:-len(".obj")] + ".mtl"
+        mesh_path = os.path.join(obj_cache, os.path.basename(mesh_fname))
+        mtl_path = os.path.join(obj_cache, os.path.basename(mtl_fname))
+        mesh_pfx = DATA_PREFIX + os.path.dirname(mesh_fname) + "/"
+        download_cached(f"{DATA_PREFIX}{mesh_fname}", mesh_path)
+        download_cached(f"{DATA_PREFIX}{mtl_fname}", mtl_path)
+        with open(mtl_path, "r") as mtl_f:
+            for line in mtl_f.read().splitlines():
+                if m := re.fullmatch(r".+ (.+\.jpg)", line):
+                    texture_fname = m.group(1)
+                    assert texture_fname == os.path.basename(texture_fname), texture_fname
+                    texture_path = os.path.join(obj_cache, texture_fname)
+                    download_cached(f"{mesh_pfx}{texture_fname}", texture_path)
+
+        T = np.array(f["grasps/transforms"])
+        mesh_scale = f["object/scale"][()]
+    obj_mesh = trimesh.load(mesh_path)
+    obj_mesh = obj_mesh.apply_scale(mesh_scale)
+    if isinstance(obj_mesh, trimesh.Scene):
+        scene = obj_mesh
+    elif isinstance(obj_mesh, trimesh.Trimesh):
+        scene = trimesh.Scene([obj_mesh])
+    else:
+        raise ValueError("Unsupported geometry type")
     return scene, T
 
 def visualize_annotation(annotation: Annotation):
@@ -114,12 +128,11 @@ def visualize_annotation(annotation: Annotation):
     print(f"\tObject Description: {annotation.obj_description}")
     print(f"\tGrasp Description: {annotation.grasp_description}")
 
-    load_object_data(annotation.obj.object_category, annotation.obj.object_id)
-
     scene, T = load_object_data(annotation.obj.object_category, annotation.obj.object_id)
     gripper_marker = create_gripper_marker(color=[0, 255, 0]).apply_transform(T[annotation.grasp_id])
-    gripper_marker.apply_translation(-scene.centroid)
-    scene.apply_translation(-scene.centroid)
+    centroid = scene.centroid
+    gripper_marker.apply_translation(-centroid)
+    scene.apply_translation(-centroid)
     scene.add_geometry(gripper_marker)
     try:
         scene.to_mesh().show()
@@ -152,22 +165,24 @@ if __name__ == "__main__":
 
     if args.visualize:
         category, obj_id, grasp_id = args.visualize
-        annot = next((a for a in annotations if a.obj.object_category == category and a.obj.object_id == obj_id and a.grasp_id == int(grasp_id)), None)
-        visualize_annotation(annot)
+        # reversed so that the first annotation of a grasp wins, like the linear scan did
+        annot_index = {(a.obj.object_category, a.obj.object_id, a.grasp_id): a for a in reversed(annotations)}
+        visualize_annotation(annot_index[(category, obj_id, int(grasp_id))])
 
     if args.random_viz:
         annotation: Annotation = np.random.choice(annotations)
         visualize_annotation(annotation)
 
+    annots_by_user: dict[str, list[Annotation]] = defaultdict(list)
+    for annotation in annotations:
+        annots_by_user[annotation.user_id].append(annotation)
+
     if args.viz_uzer:
-        for annotation in annotations:
-            if annotation.user_id == args.viz_uzer:
-                visualize_annotation(annotation)
+        for annotation in annots_by_user.get(args.viz_uzer, []):
+            visualize_annotation(annotation)
 
     if args.user_hist:
-        user_hist = {}
-        for annotation in annotations:
-            user_hist[annotation.user_id] = user_hist.get(annotation.user_id, 0) + 1
+        user_hist = {user: len(annots) for user, annots in annots_by_user.items()}
         users = [user for user in user_hist.keys() if user_hist[user] > 1]
         plt.bar(users, [user_hist[user] for user in users])
         plt.xticks(rotation=45, ha='right')
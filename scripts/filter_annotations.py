@@ -4,6 +4,7 @@ import re
 import argparse
 import time
 from pydantic import BaseModel
+from pydantic_core import to_json
 import requests
 from tqdm import tqdm
 from io import BytesIO
@@ -13,6 +14,7 @@ from itertools import compress
 from openai import OpenAI
 from openai.lib._pydantic import to_strict_json_schema
 import boto3
+from botocore.config import Config
 from types_boto3_s3.client import S3Client
 
 from annotation import Annotation, GraspLabel
@@ -20,6 +22,7 @@ from utils import list_s3_files
 
 
 BUCKET_NAME = "prior-datasets"
+N_S3_THREADS = 16
 SYS_PROMPT = """
 You are an AI assistant designed to filter out improper grasp descriptions based on a set of strict guidelines. A grasp description should be a concise and detailed explanation of the grasp's position and orientation relative to an object. Your task is to determine whether a given grasp description follows the provided guidelines.
 
@@ -97,15 +100,22 @@ def generate_query(pfx:str, annot: Annotation):
     }
 
 def submit_job(openai: OpenAI, s3: S3Client, overwrite: bool, src_prefix: str, dst_prefix: str, users: set[str] | None = None):
-    unannotated_pfxs = list_s3_files(s3, BUCKET_NAME, src_prefix)
-    if not overwrite:
-        annotated_pfxs = set(list_s3_files(s3, BUCKET_NAME, dst_prefix))
-        unannotated_pfxs = [pfx for pfx in unannotated_pfxs if pfx not in annotated_pfxs]
+    if overwrite:
+        unannotated_pfxs = list_s3_files(s3, BUCKET_NAME, src_prefix)
+    else:
+        # the two listings are independent round trips, so walk them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            src_future = executor.submit(list_s3_files, s3, BUCKET_NAME, src_prefix)
+            dst_future = executor.submit(list_s3_files, s3, BUCKET_NAME, dst_prefix)
+            unannotated_pfxs = src_future.result()
+            # filtered annotations keep their source filename under the destination prefix
+            annotated_bns = set(os.path.basename(pfx) for pfx in dst_future.result())
+        unannotated_pfxs = [pfx for pfx in unannotated_pfxs if os.path.basename(pfx) not in annotated_bns]
 
     annot_pfxs: list[str] = []
     annots: list[Annotation] = []
     n_unfiltered = len(unannotated_pfxs)
-    with ThreadPoolExecutor(max_workers=16) as executor:
+    with ThreadPoolExecutor(max_workers=N_S3_THREADS) as executor:
         futures = [executor.submit(get_annot_details, s3, pfx) for pfx in unannotated_pfxs]
         for future in tqdm(as_completed(futures), total=len(futures), dynamic_ncols=True, desc="Fetching annotations"):
             pfx, annot = future.result()
@@ -161,15 +171,19 @@ def retrieve_job(openai: OpenAI, s3: S3Client, batch_id: str, batch_file_id: str
         elif response.revised_description:
             revisions.append((pfx, response.revised_description))
 
-    for pfx in tqdm(valid_annot_pfxs, desc="Copying valid annotations"):
-        bn = os.path.basename(pfx)
-        s3.copy_object(CopySource=f"{BUCKET_NAME}/{src_prefix}{bn}",
-                       Bucket=BUCKET_NAME, Key=f"{dst_prefix}{bn}")
+    with ThreadPoolExecutor(max_workers=N_S3_THREADS) as executor:
+        futures = []
+        for pfx in valid_annot_pfxs:
+            bn = os.path.basename(pfx)
+            futures.append(executor.submit(s3.copy_object, CopySource=f"{BUCKET_NAME}/{src_prefix}{bn}",
+                                           Bucket=BUCKET_NAME, Key=f"{dst_prefix}{bn}"))
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Copying valid annotations"):
+            future.result()
 
     for pfx, revised_desc in tqdm(revisions, desc="Revising annotations"):
         annot = get_annot_details(s3, pfx)[1]
         annot = annot.model_copy(update={"grasp_description": revised_desc})
-        annot_file = BytesIO(annot.model_dump_json().encode("utf-8"))
+        annot_file = BytesIO(to_json(annot))
         annot_file.seek(0)
         bn = os.path.basename(pfx)
         s3.upload_fileobj(annot_file, BUCKET_NAME, f"{dst_prefix}{bn}")
@@ -191,7 +205,8 @@ def main():
         parser.error("If submitting and retrieving, do not provide a batch ID")
 
     openai = OpenAI()
-    s3 = boto3.client("s3")
+    # one pooled connection per worker thread, the default pool of 10 would serialize the extra threads
+    s3 = boto3.client("s3", config=Config(max_pool_connections=N_S3_THREADS, retries={"max_attempts": 10, "mode": "adaptive"}))
 
     if args.submit:
         if args.study:
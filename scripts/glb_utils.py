@@ -0,0 +1,58 @@
+import io
+import os
+import re
+from tempfile import TemporaryDirectory
+
+import h5py
+import numpy as np
+import trimesh
+from types_boto3_s3.client import S3Client
+
+from acronym_tools import create_gripper_marker
+
+GRIPPER_MARKER: trimesh.Trimesh = create_gripper_marker(color=[0, 255, 0])
+
+def download_object_data(s3: S3Client, bucket_name: str, data_prefix: str, category: str, obj_id: str) -> tuple[trimesh.Scene, np.ndarray]:
+    datafile_key = f"{data_prefix}grasps/{category}_{obj_id}.h5"
+    with TemporaryDirectory() as tmpdir:
+        datafile_path = os.path.join(tmpdir, "data.h5")
+        s3.download_file(bucket_name, datafile_key, datafile_path)
+        with h5py.File(datafile_path, "r") as f:
+            mesh_fname: str = f["object/file"][()].decode("utf-8")
+            mtl_fname = mesh_fname[:-len(".obj")] + ".mtl"
+            mesh_path = os.path.join(tmpdir, os.path.basename(mesh_fname))
+            mtl_path = os.path.join(tmpdir, os.path.basename(mtl_fname))
+            mesh_pfx = data_prefix + os.path.dirname(mesh_fname) + "/"
+            s3.download_file(bucket_name, f"{data_prefix}{mesh_fname}", mesh_path)
+            s3.download_file(bucket_name, f"{data_prefix}{mtl_fname}", mtl_path)
+            with open(mtl_path, "r") as mtl_f:
+                for line in mtl_f.read().splitlines():
+                    if m := re.fullmatch(r".+ (.+\.jpg)", line):
+                        texture_fname = m.group(1)
+                        assert texture_fname == os.path.basename(texture_fname), texture_fname
+                        texture_path = os.path.join(tmpdir, texture_fname)
+                        s3.download_file(bucket_name, f"{mesh_pfx}{texture_fname}", texture_path)
+
+            T = np.array(f["grasps/transforms"])
+            mesh_scale = f["object/scale"][()]
+        obj_mesh = trimesh.load(mesh_path)
+        obj_mesh = obj_mesh.apply_scale(mesh_scale)
+        if isinstance(obj_mesh, trimesh.Scene):
+            scene = obj_mesh
+        elif isinstance(obj_mesh, trimesh.Trimesh):
+            scene = trimesh.Scene([obj_mesh])
+        else:
+            raise ValueError("Unsupported geometry type")
+    return scene, T
+
+def export_grasp_glb(scene: trimesh.Scene, grasp_pose: np.ndarray) -> bytes:
+    # mutates scene, so callers should pass a copy if they reuse it
+    centroid = scene.centroid
+    # the marker geometry is shared, only its node transform differs per grasp
+    scene.add_geometry(GRIPPER_MARKER, node_name="gripper", transform=grasp_pose)
+    # translates every node under the base frame, including the gripper
+    scene.apply_translation(-centroid)
+
+    glb_bytes = io.BytesIO()
+    scene.export(glb_bytes, file_type="glb")
+    return glb_bytes.getvalue()
@@ -0,0 +1,66 @@
+import argparse
+import os
+import io
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import boto3
+from tqdm import tqdm
+
+from glb_utils import download_object_data, export_grasp_glb
+
+BUCKET_NAME = "prior-datasets"
+DATA_PREFIX = "semantic-grasping/acronym/"
+
+s3 = None
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Pregenerate the GLBs served by the annotation server")
+    parser.add_argument("--out-dir", default="glb_cache", help="Directory to write GLBs to, read by the server via GLB_CACHE_DIR")
+    parser.add_argument("--n-proc", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("categories", nargs="*", help="Categories to generate, defaults to all")
+    return parser.parse_args()
+
+def worker_init():
+    global s3
+    s3 = boto3.client("s3")
+
+def export_object(out_dir: str, category: str, obj_id: str, grasp_ids: list[int], overwrite: bool):
+    obj_dir = os.path.join(out_dir, category, obj_id)
+    if not overwrite:
+        grasp_ids = [gid for gid in grasp_ids if not os.path.isfile(os.path.join(obj_dir, f"{gid}.glb"))]
+    if len(grasp_ids) == 0:
+        return 0
+
+    # download and parse the object once, then export every grasp on a copy of it
+    scene, T = download_object_data(s3, BUCKET_NAME, DATA_PREFIX, category, obj_id)
+    os.makedirs(obj_dir, exist_ok=True)
+    for gid in grasp_ids:
+        glb_path = os.path.join(obj_dir, f"{gid}.glb")
+        with open(glb_path + ".tmp", "wb") as f:
+            f.write(export_grasp_glb(scene.copy(), T[gid]))
+        os.replace(glb_path + ".tmp", glb_path)
+    return len(grasp_ids)
+
+def main():
+    args = get_args()
+
+    skeleton_bytes = io.BytesIO()
+    boto3.client("s3").download_fileobj(BUCKET_NAME, f"{DATA_PREFIX}annotation_skeleton.pkl", skeleton_bytes)
+    skeleton_bytes.seek(0)
+    skeleton: dict[str, dict[str, dict[int, bool]]] = pickle.load(skeleton_bytes)
+
+    categories = args.categories or list(skeleton.keys())
+    with ProcessPoolExecutor(args.n_proc, initializer=worker_init) as executor:
+        futures = []
+        for category in categories:
+            for obj_id, grasps in skeleton[category].items():
+                futures.append(executor.submit(export_object, args.out_dir, category, obj_id, list(grasps.keys()), args.overwrite))
+        n_written = 0
+        for future in tqdm(as_completed(futures), total=len(futures), dynamic_ncols=True, desc="Exporting GLBs"):
+            n_written += future.result()
+    print(f"Wrote {n_written} GLBs to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
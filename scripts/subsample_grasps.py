@@ -209,7 +209,7 @@ def load_aligned_meshes_and_grasps(category: str, obj_ids: list[str], n_proc=16)
     return meshes, grasps, grasp_succs
 
 def sample_grasps(grasps: list[np.ndarray], grasp_succs: list[np.ndarray], n_grasps: int) -> list[list[int]]:
-    grasp_succ_idxs = [np.nonzero(succ)[0] for succ in grasp_succs]
+    grasp_succ_idxs = [np.flatnonzero(succ) for succ in grasp_succs]
     n_instances = len(grasps)
 
     all_grasps = np.concatenate([g[idxs] for g, idxs in zip(grasps, grasp_succ_idxs)], axis=0)